@@ -1,13 +1,48 @@
 import streamlit as st
 import pandas as pd
+from pandas.api.types import (
+    is_datetime64_any_dtype,
+    is_numeric_dtype,
+    is_object_dtype,
+)
 from tcia_utils import nbia
 import datetime
+import io
+import itertools
+import numpy as np
 import plotly.express as px
+from concurrent.futures import ThreadPoolExecutor
 
-def preprocess_age(age):
-    if pd.isna(age) or age == 'None':
-        return None
-    return int(age.rstrip('Y'))
+# copy columns lazily on write instead of deep-copying whole frames (pandas >= 2.0)
+pd.options.mode.copy_on_write = True
+
+# maximum number of concurrent requests sent to the NBIA API
+MAX_WORKERS = 8
+
+# number of rows written per chunk when serializing the report CSV
+CSV_CHUNKSIZE = 50_000
+
+# maximum number of patient IDs sent in a single getAdvancedQCSearch request
+QC_BATCH_SIZE = 500
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def preprocess_age(ages):
+    # convert DICOM age strings (e.g. '065Y') to nullable integers; only the distinct
+    # values are parsed (there are at most a few hundred) and the result is mapped back
+    unique_ages = pd.Series(ages.dropna().unique())
+    parsed = unique_ages.where(unique_ages != 'None').astype('string')
+    parsed = pd.to_numeric(parsed.str.rstrip('Y'), errors='coerce').astype('Int64')
+    return ages.map(pd.Series(parsed.array, index=unique_ages)).astype('Int64')
+
+def _looks_like_date(value) -> bool:
+    try:
+        pd.to_datetime(value)
+    except Exception:
+        return False
+    return True
 
 def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -24,18 +59,25 @@ def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     if not modify:
         return df
 
-    df = df.copy()
-
     # Try to convert datetimes into a standard format (datetime, no timezone)
+    # Only columns named like a date, or whose first value parses as one, are converted
+    converted = {}
     for col in df.columns:
-        if is_object_dtype(df[col]):
-            try:
-                df[col] = pd.to_datetime(df[col])
-            except Exception:
-                pass
-
-        if is_datetime64_any_dtype(df[col]):
-            df[col] = df[col].dt.tz_localize(None)
+        series = df[col]
+        if is_object_dtype(series):
+            sample = series.dropna().head(5)
+            if not sample.empty and ('date' in col.lower() or _looks_like_date(sample.iloc[0])):
+                try:
+                    series = pd.to_datetime(series, errors='raise')
+                except Exception:
+                    pass
+
+        if is_datetime64_any_dtype(series):
+            converted[col] = series.dt.tz_localize(None)
+
+    # assign returns a new frame, so only converted columns are copied and the caller's df is untouched
+    if converted:
+        df = df.assign(**converted)
 
     modification_container = st.container()
 
@@ -45,13 +87,19 @@ def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
             left, right = st.columns((1, 20))
             left.write("↳")
             # Treat columns with < 10 unique values as categorical
-            if is_categorical_dtype(df[column]) or df[column].nunique() < 10:
+            if isinstance(df[column].dtype, pd.CategoricalDtype) or df[column].nunique() < 10:
                 user_cat_input = right.multiselect(
                     f"Values for {column}",
                     df[column].unique(),
                     default=list(df[column].unique()),
                 )
-                df = df[df[column].isin(user_cat_input)]
+                if isinstance(df[column].dtype, pd.CategoricalDtype):
+                    # compare integer category codes instead of hashing the values; a selected
+                    # NaN maps to -1, the code of missing values, so this matches isin
+                    selected_codes = df[column].cat.categories.get_indexer(user_cat_input)
+                    df = df[np.isin(df[column].cat.codes.to_numpy(), selected_codes)]
+                else:
+                    df = df[df[column].isin(user_cat_input)]
             elif is_numeric_dtype(df[column]):
                 _min = float(df[column].min())
                 _max = float(df[column].max())
@@ -85,43 +133,91 @@ def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
 
     return df
 
-#@st.cache_data
-def generate_monthly_report():
-    # get list of all collections
-    collections_json = nbia.getCollections()
-    collections = [item['Collection'] for item in collections_json]
-
-    # select only APOLLO-5 collections
-    collectionSubset = [item for item in collections if "APOLLO-5" in item]
-    collections = collectionSubset
-    st.write(f"{len(collections)} APOLLO-5 collections are being analyzed.")
-    st.write(collections)
-
+def _check_response(result, expected_type, endpoint):
+    # tcia_utils returns an HTTP status code (or None) instead of raising on failure;
+    # raising here keeps st.cache_data from storing the failure for the whole TTL
+    if not isinstance(result, expected_type):
+        raise RuntimeError(f"NBIA {endpoint} request failed: {result!r}")
+    return result
+
+# The cached NBIA wrappers below take the username as their first argument. It isn't used
+# in the call itself (the token from nbia.getToken is), but it keeps the cache key per user:
+# st.cache_data is shared by every session and results depend on each account's permissions.
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_get_collections(username):
+    return _check_response(nbia.getCollections(), list, "getCollections")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_get_study(username, collection):
+    # raw list of study dicts; the DataFrame is built once from all collections
+    result = nbia.getStudy(collection)
+    # None means the collection has no studies
+    if result is None:
+        return []
+    return _check_response(result, list, "getStudy")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_get_advanced_qc(username, patient_id_list):
+    criteria_values = [("patientID", patient_id_list)]
+    return _check_response(nbia.getAdvancedQCSearch(criteria_values, format="df"), pd.DataFrame,
+                           "getAdvancedQCSearch")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_get_series_list(username, series_list):
+    # series_list is a tuple so it can be hashed by st.cache_data
+    return _check_response(nbia.getSeriesList(list(series_list), format="df"), pd.DataFrame,
+                           "getSeriesList")
+
+@st.cache_data(show_spinner=False)
+def _to_csv_bytes(df: pd.DataFrame) -> bytes:
+    # the whole CSV is held in the buffer (and copied by getvalue); chunksize only limits
+    # how many rows are formatted at a time
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, chunksize=CSV_CHUNKSIZE)
+    return buffer.getvalue()
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _build_study_report(username, collections):
     # get inventory of studies
-    studies = pd.DataFrame()
+    # each getStudy call is independent and I/O bound, so fetch collections concurrently
+    # (executor.map returns results in the same order as collections)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        study_lists = executor.map(lambda collection: _cached_get_study(username, collection), collections)
+        records = list(itertools.chain.from_iterable(study_lists))
+
+    # build the DataFrame once from all records rather than one frame per collection
+    studies = pd.DataFrame.from_records(records)
 
-    for collection in collections:
-        studyDescription = nbia.getStudy(collection)
-        studies = pd.concat([studies, pd.DataFrame(studyDescription)], ignore_index=True)
+    # drop unnecessary columns before joining so the merge doesn't carry them; 'Collection'
+    # is replaced by the one parsed from collectionSite below
+    studies = studies.drop(columns=[c for c in ['AdmittingDiagnosesDescription', 'PatientName', 'Collection']
+                                    if c in studies.columns])
 
     # get unique patient IDs from studies dataframe
     unique_patient_ids = studies['PatientID'].unique()
 
-    # Convert the unique patient IDs to a comma-separated string
-    patient_id_list = ",".join(unique_patient_ids)
+    # Convert batches of the unique patient IDs to comma-separated strings
+    # so no single request carries thousands of IDs
+    patient_id_lists = [",".join(ids) for ids in _chunks(list(unique_patient_ids), QC_BATCH_SIZE)]
 
-    # call getAdvancedQCSearch to get collection//site info for these subjects
-    criteria_values = [("patientID", patient_id_list)]
-    series_site_info = nbia.getAdvancedQCSearch(criteria_values, format="df")
+    # call getAdvancedQCSearch to get collection//site info for these subjects, one batch per request
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        parts = list(executor.map(lambda ids: _cached_get_advanced_qc(username, ids), patient_id_lists))
+    # a single batch (the usual case for a month with few patients) skips concat's alignment work
+    if len(parts) == 1:
+        series_site_info = parts[0].reset_index(drop=True)
+    else:
+        series_site_info = pd.concat(parts, ignore_index=True, copy=False)
 
     # Rename the 'study' column to 'StudyInstanceUID'
     series_site_info = series_site_info.rename(columns={'study': 'StudyInstanceUID'})
 
     # extract series column from series_site_info df to list
-    series_list = series_site_info['series'].tolist()
+    series_list = tuple(series_site_info['series'].tolist())
 
     # use nbia.getSeriesList to look up series metadata
-    series_info = nbia.getSeriesList(series_list, format="df")
+    series_info = _cached_get_series_list(username, series_list)
 
     # for each unique Study UID value, calculate the sum of the Number of images column
     image_counts_by_study = series_info.groupby('Study UID')['Number of images'].sum().reset_index()
@@ -136,26 +232,29 @@ def generate_monthly_report():
     columns_to_keep = ['StudyInstanceUID', 'collectionSite']
     series_site_info = series_site_info[columns_to_keep]
 
-    # Remove duplicates based on 'StudyInstanceUID' and 'collectionSite'
-    series_site_info = series_site_info.drop_duplicates(subset=['StudyInstanceUID', 'collectionSite'])
-
-    # Merge 'series_site_info' with 'studies' on 'StudyInstanceUID'
-    apollo5_study_report = pd.merge(studies, series_site_info, on='StudyInstanceUID', how='left')
-
-    # Merge the 'ImageCount' column from image_counts_by_study into apollo5_study_report
-    apollo5_study_report = pd.merge(apollo5_study_report, image_counts_by_study, on='StudyInstanceUID', how='left')
+    # Remove duplicates so there is one collectionSite per 'StudyInstanceUID'
+    series_site_info = series_site_info.drop_duplicates(subset=['StudyInstanceUID'])
 
-    # drop unnecessary columns
-    apollo5_study_report.drop(columns=['Collection', 'AdmittingDiagnosesDescription', 'PatientName'], inplace=True)
+    # Split the 'collectionSite' column into 'Collection' and 'Site' and drop the original column;
+    # doing this on the deduplicated lookup table parses far fewer strings than the joined report
+    collection_site = series_site_info['collectionSite'].str.partition('//')
+    series_site_info = series_site_info.assign(
+        Collection=collection_site[0],
+        # a collectionSite without '//' has no site; keep it missing as split() did, not ''
+        Site=collection_site[2].replace('', pd.NA),
+    ).drop(columns=['collectionSite'])
 
-    # Split the 'collectionSite' column into 'Collection' and 'Site'
-    apollo5_study_report[['Collection', 'Site']] = apollo5_study_report['collectionSite'].str.split('//', expand=True)
+    # Merge the split 'Collection' and 'Site' columns into 'studies' on 'StudyInstanceUID'
+    # (series_site_info is unique per study, so each study row matches at most once)
+    apollo5_study_report = pd.merge(studies, series_site_info, on='StudyInstanceUID', how='left',
+                                    sort=False, validate='m:1')
 
-    # Drop the original 'collectionSite' column
-    apollo5_study_report = apollo5_study_report.drop(columns=['collectionSite'])
+    # ImageCount attaches a single value per StudyInstanceUID, so map it from an indexed Series
+    image_count_map = image_counts_by_study.set_index('StudyInstanceUID')['ImageCount']
+    apollo5_study_report['ImageCount'] = apollo5_study_report['StudyInstanceUID'].map(image_count_map)
 
     # Preprocess the PatientAge column
-    apollo5_study_report['PatientAge_Numeric'] = apollo5_study_report['PatientAge'].apply(preprocess_age)
+    apollo5_study_report['PatientAge_Numeric'] = preprocess_age(apollo5_study_report['PatientAge'])
 
     # Define the new order of columns
     new_order = ['PatientID', 'Collection', 'Site', 'LongitudinalTemporalEventType', 'LongitudinalTemporalOffsetFromEvent', 'StudyDate', 'StudyInstanceUID', 'StudyDescription', 'SeriesCount', 'ImageCount', 'PatientAge', 'PatientAge_Numeric', 'PatientSex', 'EthnicGroup']
@@ -163,11 +262,98 @@ def generate_monthly_report():
     # Reorder the columns
     apollo5_study_report = apollo5_study_report.reindex(columns=new_order)
 
+    # store low-cardinality columns as categoricals so groupbys and value counts work on integer codes
+    for col in ['Collection', 'Site', 'PatientSex', 'EthnicGroup', 'LongitudinalTemporalEventType']:
+        if col in apollo5_study_report.columns:
+            apollo5_study_report[col] = apollo5_study_report[col].astype('category')
+
+    return apollo5_study_report
+
+def generate_monthly_report(username):
+    # get list of all collections
+    collections_json = _cached_get_collections(username)
+    collections = [item['Collection'] for item in collections_json]
+
+    # select only APOLLO-5 collections
+    collectionSubset = [item for item in collections if "APOLLO-5" in item]
+    collections = collectionSubset
+    st.write(f"{len(collections)} APOLLO-5 collections are being analyzed.")
+    st.write(collections)
+
+    # build the report, memoized per user on the set of collections being analyzed
+    apollo5_study_report = _build_study_report(username, tuple(sorted(collections)))
+
     # save merged report to a CSV
     csv_filename = f"apollo5-monthly-report_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M')}.csv"
-    apollo5_study_report.to_csv(csv_filename, index=False)
-
-    return apollo5_study_report, csv_filename
+    csv_bytes = _to_csv_bytes(apollo5_study_report)
+    with open(csv_filename, 'wb') as f:
+        f.write(csv_bytes)
+
+    return apollo5_study_report, csv_filename, csv_bytes
+
+def _binned_histogram(values, title, x_label):
+    # bin on the server so the figure carries one bar per bin rather than every row
+    values = pd.to_numeric(values, errors='coerce').dropna().to_numpy(dtype=float)
+    edges = np.histogram_bin_edges(values, bins='auto')
+    if values.size and np.all(values == np.round(values)):
+        # integer data (ages, days) gets a whole-number bin width with edges between integers,
+        # so every bin covers the same number of distinct values
+        lo, hi = values.min(), values.max()
+        step = max(1, int(np.ceil((hi - lo + 1) / (len(edges) - 1))))
+        edges = np.arange(lo, hi + step + 1, step) - 0.5
+    counts, edges = np.histogram(values, bins=edges)
+    fig = px.bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, title=title,
+                 labels={'x': x_label, 'y': 'Count'})
+    fig.update_traces(width=np.diff(edges))
+    fig.update_layout(bargap=0)
+    return fig
+
+@st.cache_data(show_spinner=False)
+def _collection_figures(df):
+    # shared per-Collection aggregates, computed in a single groupby
+    collection_stats = df.groupby('Collection', observed=True).agg(
+        PatientID=('PatientID', 'nunique'),
+        ImageCount=('ImageCount', 'sum'),
+    ).reset_index()
+
+    # PatientID by Collection
+    fig_collection = px.pie(collection_stats, values='PatientID', names='Collection',
+                            title="PatientID by Collection")
+
+    # Image Count by Collection
+    fig_image_count = px.bar(collection_stats, x='Collection', y='ImageCount', title="Total Image Count by Collection")
+
+    return fig_collection, fig_image_count
+
+@st.cache_data(show_spinner=False)
+def _demographic_figures(unique_patients):
+    # Patient Sex distribution (unique PatientIDs)
+    sex_counts = unique_patients['PatientSex'].value_counts()
+    fig_sex = px.pie(values=sex_counts.values, names=sex_counts.index,
+                     title="Distribution of Patient Sex (Unique PatientIDs)")
+
+    # Patient Age distribution (ordered from youngest to oldest)
+    fig_age = _binned_histogram(unique_patients['PatientAge_Numeric'],
+                                title="Distribution of Patient Ages (Unique PatientIDs)",
+                                x_label="Patient Age (Years)")
+
+    return fig_sex, fig_age
+
+@st.cache_data(show_spinner=False)
+def _temporal_figures(df):
+    # LongitudinalTemporalOffsetFromEvent distribution
+    fig_offset = _binned_histogram(df['LongitudinalTemporalOffsetFromEvent'],
+                                   title="Distribution of Days Since Diagnosis",
+                                   x_label="Days Since Diagnosis")
+
+    # Number of unique StudyDate values for each PatientID (sorted in descending order)
+    study_dates_per_patient = df.groupby('PatientID')['StudyDate'].nunique().reset_index()
+    study_dates_per_patient = study_dates_per_patient.rename(columns={'StudyDate': 'Number of Study Dates'})
+    study_dates_per_patient = study_dates_per_patient.sort_values('Number of Study Dates', ascending=False)
+    fig_study_dates = px.bar(study_dates_per_patient, x='PatientID', y='Number of Study Dates',
+                             title="Number of Unique Study Dates per Patient")
+
+    return fig_offset, fig_study_dates
 
 def main():
 
@@ -198,7 +384,7 @@ def main():
 
                     if selected_report == "Monthly Report":
                         with st.spinner("Generating Monthly Report..."):
-                            df, csv_filename = generate_monthly_report()
+                            df, csv_filename, csv_bytes = generate_monthly_report(username)
 
                         st.success("Monthly Report generated successfully!")
 
@@ -212,7 +398,7 @@ def main():
                         # Offer CSV download
                         st.download_button(
                             label="Download CSV",
-                            data=df.to_csv(index=False),
+                            data=csv_bytes,
                             file_name=csv_filename,
                             mime="text/csv"
                         )
@@ -220,48 +406,29 @@ def main():
                         # Visualizations
                         st.subheader("Visualizations")
 
-                        col1, col2 = st.columns(2)
-
-                        with col1:
-                            # PatientID by Collection
-                            patient_counts = df.groupby('Collection')['PatientID'].nunique().reset_index()
-                            fig_collection = px.pie(patient_counts, values='PatientID', names='Collection',
-                                                    title="PatientID by Collection")
-                            st.plotly_chart(fig_collection)
-
-                            # Patient Sex distribution (unique PatientIDs)
-                            sex_counts = df.drop_duplicates('PatientID')['PatientSex'].value_counts()
-                            fig_sex = px.pie(values=sex_counts.values, names=sex_counts.index,
-                                             title="Distribution of Patient Sex (Unique PatientIDs)")
-                            st.plotly_chart(fig_sex)
-
-                        with col2:
-                            # Image Count by Collection
-                            fig_image_count = px.bar(df.groupby('Collection')['ImageCount'].sum().reset_index(),
-                                                     x='Collection', y='ImageCount', title="Total Image Count by Collection")
-                            st.plotly_chart(fig_image_count)
-
-                            # Patient Age distribution (ordered from youngest to oldest)
-                            age_data = df.drop_duplicates('PatientID')
-                            age_data = age_data[age_data['PatientAge_Numeric'].notna()]
-                            fig_age = px.histogram(age_data, x='PatientAge_Numeric',
-                                                   title="Distribution of Patient Ages (Unique PatientIDs)")
-                            fig_age.update_xaxes(title_text="Patient Age (Years)")
-                            st.plotly_chart(fig_age)
-
-                        # LongitudinalTemporalOffsetFromEvent distribution
-                        fig_offset = px.histogram(df, x='LongitudinalTemporalOffsetFromEvent',
-                                                  title="Distribution of Days Since Diagnosis",
-                                                  labels={'LongitudinalTemporalOffsetFromEvent': 'Days Since Diagnosis'})
-                        st.plotly_chart(fig_offset)
-
-                        # Number of unique StudyDate values for each PatientID (sorted in descending order)
-                        study_dates_per_patient = df.groupby('PatientID')['StudyDate'].nunique().reset_index()
-                        study_dates_per_patient = study_dates_per_patient.rename(columns={'StudyDate': 'Number of Study Dates'})
-                        study_dates_per_patient = study_dates_per_patient.sort_values('Number of Study Dates', ascending=False)
-                        fig_study_dates = px.bar(study_dates_per_patient, x='PatientID', y='Number of Study Dates',
-                                                 title="Number of Unique Study Dates per Patient")
-                        st.plotly_chart(fig_study_dates)
+                        # one row per patient, shared by the demographic charts
+                        patients_unique = df[['PatientID', 'PatientSex', 'PatientAge_Numeric']].drop_duplicates(
+                            'PatientID', keep='first')
+
+                        tab_collection, tab_demographics, tab_temporal = st.tabs(
+                            ["Collection", "Demographics", "Temporal"])
+
+                        with tab_collection:
+                            fig_collection, fig_image_count = _collection_figures(df)
+                            col1, col2 = st.columns(2)
+                            col1.plotly_chart(fig_collection)
+                            col2.plotly_chart(fig_image_count)
+
+                        with tab_demographics:
+                            fig_sex, fig_age = _demographic_figures(patients_unique)
+                            col1, col2 = st.columns(2)
+                            col1.plotly_chart(fig_sex)
+                            col2.plotly_chart(fig_age)
+
+                        with tab_temporal:
+                            fig_offset, fig_study_dates = _temporal_figures(df)
+                            st.plotly_chart(fig_offset)
+                            st.plotly_chart(fig_study_dates)
 
                 else:
                     st.error("Login failed. Please check your credentials.")